@@ -1,33 +1,984 @@
 import sys
 import os
+import re
+import math
+import time
+import tempfile
+import itertools
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
 import fitz  # PyMuPDF
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                              QPushButton, QLabel, QSlider, QSpinBox, QToolBar, 
                              QAction, QFileDialog, QColorDialog, QMessageBox,
-                             QWidget, QSplitter, QListWidget, QTextEdit, QScrollArea)
-from PyQt5.QtCore import Qt, QPoint, QRect
-from PyQt5.QtGui import QPixmap, QImage, QPainter, QPen, QColor, QFont, QIcon
+                             QWidget, QSplitter, QListWidget, QListWidgetItem, QTextEdit,
+                             QScrollArea, QTabBar, QAbstractItemView, QInputDialog,
+                             QProgressDialog)
+from PyQt5.QtCore import Qt, QPointF, QRect, QRectF, QItemSelectionModel, QTimer
+from PyQt5.QtGui import (QPixmap, QImage, QPainter, QPainterPath, QPen, QColor,
+                         QFont, QIcon, QTransform)
 from PyQt5.QtPrintSupport import QPrintDialog, QPrinter
 
 
+# Общий бюджет памяти на отрендеренные страницы всех открытых документов
+RENDER_CACHE_BUDGET = 256 * 1024 * 1024
+
+
+class RenderCache:
+    """Общий LRU-кэш отрендеренных страниц для всех открытых документов.
+
+    Ключ записи: (doc_id, page_xref, scale, device_pixel_ratio), поэтому
+    рендеры для экранов с разной плотностью пикселей хранятся рядом и
+    переживают перенос окна между мониторами. Суммарный размер ограничен
+    бюджетом в байтах; при переполнении сначала вытесняются страницы
+    неактивных документов, затем самые старые страницы активного.
+    """
+
+    def __init__(self, budget=RENDER_CACHE_BUDGET):
+        self.budget = budget
+        self.used = 0
+        self._entries = OrderedDict()  # key -> (pixmap, nbytes)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, pixmap, active_doc_id=None):
+        if key in self._entries:
+            self._remove(key)
+        nbytes = pixmap.width() * pixmap.height() * 4
+        self._entries[key] = (pixmap, nbytes)
+        self.used += nbytes
+        self._shrink(active_doc_id, keep=key)
+
+    def evict_document(self, doc_id):
+        """Удаляет из кэша все страницы документа (при закрытии вкладки)"""
+        for key in [k for k in self._entries if k[0] == doc_id]:
+            self._remove(key)
+
+    def evict_pages(self, doc_id, xrefs):
+        """Удаляет из кэша только указанные страницы документа (поворот, удаление)"""
+        xrefs = set(xrefs)
+        for key in [k for k in self._entries if k[0] == doc_id and k[1] in xrefs]:
+            self._remove(key)
+
+    def _remove(self, key):
+        _, nbytes = self._entries.pop(key)
+        self.used -= nbytes
+
+    def _shrink(self, active_doc_id, keep):
+        if self.used <= self.budget:
+            return
+        # Порядок OrderedDict - от давно использованных к недавним
+        inactive = [k for k in self._entries if k[0] != active_doc_id]
+        active = [k for k in self._entries if k[0] == active_doc_id]
+        for key in inactive + active:
+            if self.used <= self.budget:
+                break
+            if key != keep:
+                self._remove(key)
+
+
+# Один кэш на все окна и вкладки приложения
+render_cache = RenderCache()
+
+
+# Размер ячейки сетки пространственного индекса, в пунктах PDF
+GRID_CELL_SIZE = 32.0
+
+
+def annotation_bbox(ann):
+    """Ограничивающий прямоугольник аннотации (x0, y0, x1, y1) в координатах страницы"""
+    if ann['type'] == 'pencil':
+        xs = [x for x, _ in ann['points']]
+        ys = [y for _, y in ann['points']]
+        pad = ann['width'] / 2
+        return (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+    if ann['type'] == 'redact':
+        return ann['rect']
+    if ann['type'] == 'highlight':
+        rects = ann['rects']
+        return (min(r[0] for r in rects), min(r[1] for r in rects),
+                max(r[2] for r in rects), max(r[3] for r in rects))
+    # Текст рисуется от базовой линии шрифтом высотой 12 пунктов
+    x, y = ann['position'].x(), ann['position'].y()
+    width = fitz.get_text_length(ann['text'], fontsize=12)
+    return (x, y - 12, x + width, y + 3)
+
+
+def distance_to_polyline(x, y, points):
+    """Расстояние от точки до ломаной, заданной списком точек"""
+    if len(points) == 1:
+        return math.hypot(x - points[0][0], y - points[0][1])
+    best = math.inf
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        dx, dy = x1 - x0, y1 - y0
+        length2 = dx * dx + dy * dy
+        t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / length2))
+        best = min(best, math.hypot(x - x0 - t * dx, y - y0 - t * dy))
+    return best
+
+
+class SpatialIndex:
+    """Равномерная сетка над прямоугольниками аннотаций одной страницы.
+
+    Аннотация регистрируется во всех ячейках, которые пересекает её
+    прямоугольник, поэтому проверка попадания просматривает только
+    аннотации из ячеек вокруг точки, а не все штрихи страницы.
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (col, row) -> {id(ann): ann}
+        self.entries = {}  # id(ann) -> list of cells
+
+    def _cells(self, x0, y0, x1, y1):
+        size = self.cell_size
+        return [(col, row)
+                for col in range(int(math.floor(x0 / size)), int(math.floor(x1 / size)) + 1)
+                for row in range(int(math.floor(y0 / size)), int(math.floor(y1 / size)) + 1)]
+
+    def insert(self, ann):
+        cells = self._cells(*ann['bbox'])
+        for cell in cells:
+            self.cells.setdefault(cell, {})[id(ann)] = ann
+        self.entries[id(ann)] = cells
+
+    def remove(self, ann):
+        for cell in self.entries.pop(id(ann), []):
+            bucket = self.cells[cell]
+            del bucket[id(ann)]
+            if not bucket:
+                del self.cells[cell]
+
+    def query(self, x, y, radius):
+        """Аннотации, чьи прямоугольники лежат не дальше radius от точки"""
+        found = {}
+        for cell in self._cells(x - radius, y - radius, x + radius, y + radius):
+            found.update(self.cells.get(cell, {}))
+        return [ann for ann in found.values()
+                if ann['bbox'][0] - radius <= x <= ann['bbox'][2] + radius
+                and ann['bbox'][1] - radius <= y <= ann['bbox'][3] + radius]
+
+
+def single_moved_page(order):
+    """Если order получен перемещением одной страницы, возвращает аргументы
+    для Document.move_page (страница, перед какой страницей вставить), иначе None"""
+    first = next((i for i, page_num in enumerate(order) if page_num != i), None)
+    if first is None:
+        return None
+    # Перемещенной может быть либо страница, пришедшая на место first, либо ушедшая с него
+    for candidate in (order[first], first):
+        rest = [page_num for page_num in order if page_num != candidate]
+        if all(a < b for a, b in zip(rest, rest[1:])):
+            position = order.index(candidate)
+            return candidate, rest[position] if position < len(rest) else -1
+    return None
+
+
+class AnnotationStore:
+    """Аннотации документа, разложенные по страницам.
+
+    Любое изменение страницы увеличивает номер её ревизии: по нему окно
+    понимает, что слой аннотаций именно этой страницы нужно перерисовать.
+    Пространственный индекс страницы строится при первой проверке
+    попадания и дальше поддерживается при каждом изменении.
+    """
+
+    def __init__(self):
+        self.pages = {}  # page -> list of annotation dicts
+        self.revisions = {}
+        self.indexes = {}  # page -> SpatialIndex
+
+    def __iter__(self):
+        for page_num in sorted(self.pages):
+            yield from self.pages[page_num]
+
+    def page(self, page_num):
+        return self.pages.get(page_num, [])
+
+    def revision(self, page_num):
+        return self.revisions.get(page_num, 0)
+
+    def touch(self, page_num):
+        self.revisions[page_num] = self.revision(page_num) + 1
+
+    def insert(self, ann, index=None):
+        items = self.pages.setdefault(ann['page'], [])
+        items.insert(len(items) if index is None else index, ann)
+        ann['bbox'] = annotation_bbox(ann)
+        if ann['page'] in self.indexes:
+            self.indexes[ann['page']].insert(ann)
+        self.touch(ann['page'])
+
+    def remove(self, ann):
+        """Удаляет аннотацию и возвращает её прежнюю позицию на странице"""
+        items = self.pages[ann['page']]
+        # Сравниваем по идентичности: словари с одинаковым содержимым различны
+        index = next(i for i, item in enumerate(items) if item is ann)
+        del items[index]
+        if ann['page'] in self.indexes:
+            self.indexes[ann['page']].remove(ann)
+        self.touch(ann['page'])
+        return index
+
+    def translate(self, ann, dx, dy):
+        """Сдвигает аннотацию на (dx, dy) пунктов и обновляет индекс"""
+        index = self.indexes.get(ann['page'])
+        if index:
+            index.remove(ann)
+        if ann['type'] == 'pencil':
+            ann['points'] = [(x + dx, y + dy) for x, y in ann['points']]
+            ann['path'].translate(dx, dy)
+        elif ann['type'] == 'highlight':
+            ann['rects'] = [(x0 + dx, y0 + dy, x1 + dx, y1 + dy) for x0, y0, x1, y1 in ann['rects']]
+        elif ann['type'] == 'redact':
+            x0, y0, x1, y1 = ann['rect']
+            ann['rect'] = (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+        else:
+            ann['position'] = ann['position'] + QPointF(dx, dy)
+        ann['bbox'] = annotation_bbox(ann)
+        if index:
+            index.insert(ann)
+        self.touch(ann['page'])
+
+    def hit_test(self, page_num, point, tolerance):
+        """Возвращает верхнюю аннотацию страницы под точкой или None"""
+        index = self.indexes.get(page_num)
+        if index is None:
+            index = self.indexes[page_num] = SpatialIndex()
+            for ann in self.page(page_num):
+                index.insert(ann)
+        
+        x, y = point.x(), point.y()
+        hits = []
+        for ann in index.query(x, y, tolerance):
+            if ann['type'] == 'pencil':
+                if distance_to_polyline(x, y, ann['points']) > ann['width'] / 2 + tolerance:
+                    continue
+            elif ann['type'] == 'highlight':
+                # Многострочное выделение покрывает не весь свой прямоугольник
+                if not any(x0 - tolerance <= x <= x1 + tolerance and y0 - tolerance <= y <= y1 + tolerance
+                           for x0, y0, x1, y1 in ann['rects']):
+                    continue
+            hits.append(ann)
+        if len(hits) <= 1:
+            return hits[0] if hits else None
+        # Верхней считается аннотация, нарисованная последней
+        hit_ids = {id(ann) for ann in hits}
+        return next(ann for ann in reversed(self.page(page_num)) if id(ann) in hit_ids)
+
+    def remap(self, mapping):
+        """Переносит аннотации на новые номера страниц.
+
+        mapping: старый номер -> новый; аннотации страниц, которых нет
+        в mapping (удаленных), отбрасываются.
+        """
+        pages = {}
+        for page_num, items in self.pages.items():
+            if page_num not in mapping:
+                continue
+            for ann in items:
+                ann['page'] = mapping[page_num]
+            pages[mapping[page_num]] = items
+        self.pages = pages
+        self.indexes = {mapping[p]: index for p, index in self.indexes.items() if p in mapping}
+        self.revisions = {mapping[p]: rev + 1 for p, rev in self.revisions.items() if p in mapping}
+
+    def replace_page(self, page_num, items):
+        """Заменяет список аннотаций страницы и возвращает прежний"""
+        old = self.pages.pop(page_num, [])
+        if items:
+            self.pages[page_num] = items
+        # Индекс перестроится при следующей проверке попадания
+        self.indexes.pop(page_num, None)
+        self.touch(page_num)
+        return old
+
+
+class AddAnnotationCommand:
+    """Добавление одной аннотации (штрих или текст)"""
+
+    def __init__(self, ann):
+        self.ann = ann
+        self.page = ann['page']
+
+    def redo(self, store):
+        store.insert(self.ann)
+
+    def undo(self, store):
+        store.remove(self.ann)
+
+    def remap_pages(self, mapping):
+        self.page = self.ann['page'] = mapping[self.page]
+
+
+class RemoveAnnotationCommand:
+    """Удаление одной аннотации (ластик, Delete)"""
+
+    def __init__(self, ann):
+        self.ann = ann
+        self.page = ann['page']
+        self.index = None
+
+    def redo(self, store):
+        self.index = store.remove(self.ann)
+
+    def undo(self, store):
+        store.insert(self.ann, self.index)
+
+    def remap_pages(self, mapping):
+        self.page = self.ann['page'] = mapping[self.page]
+
+
+class MoveAnnotationCommand:
+    """Перемещение аннотации на (dx, dy) пунктов"""
+
+    def __init__(self, ann, dx, dy):
+        self.ann = ann
+        self.page = ann['page']
+        self.dx = dx
+        self.dy = dy
+
+    def redo(self, store):
+        store.translate(self.ann, self.dx, self.dy)
+
+    def undo(self, store):
+        store.translate(self.ann, -self.dx, -self.dy)
+
+    def remap_pages(self, mapping):
+        self.page = self.ann['page'] = mapping[self.page]
+
+
+class ClearPageCommand:
+    """Удаление всех аннотаций страницы; хранит ссылку на удаленный список"""
+
+    def __init__(self, page):
+        self.page = page
+        self.removed = []
+
+    def redo(self, store):
+        self.removed = store.replace_page(self.page, [])
+
+    def undo(self, store):
+        store.replace_page(self.page, self.removed)
+
+    def remap_pages(self, mapping):
+        self.page = mapping[self.page]
+        for ann in self.removed:
+            ann['page'] = self.page
+
+
+class UndoStack:
+    """Журнал команд редактирования аннотаций.
+
+    Команды ссылаются на сами объекты аннотаций, а не на снимки страниц,
+    поэтому история занимает память пропорционально числу правок.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.commands = []
+        self.index = 0
+
+    def can_undo(self):
+        return self.index > 0
+
+    def can_redo(self):
+        return self.index < len(self.commands)
+
+    def push(self, command):
+        """Выполняет команду и записывает её в историю"""
+        command.redo(self.store)
+        del self.commands[self.index:]
+        self.commands.append(command)
+        self.index += 1
+
+    def undo(self):
+        """Отменяет последнюю команду и возвращает номер затронутой страницы"""
+        if not self.can_undo():
+            return None
+        self.index -= 1
+        command = self.commands[self.index]
+        command.undo(self.store)
+        return command.page
+
+    def redo(self):
+        """Повторяет отмененную команду и возвращает номер затронутой страницы"""
+        if not self.can_redo():
+            return None
+        command = self.commands[self.index]
+        command.redo(self.store)
+        self.index += 1
+        return command.page
+
+    def remap_pages(self, mapping):
+        """Переносит историю на новые номера страниц после операций со страницами.
+
+        Команды удаленных страниц выбрасываются: каждая команда затрагивает
+        только свою страницу, поэтому остальная история остается согласованной.
+        """
+        commands = []
+        index = 0
+        for position, command in enumerate(self.commands):
+            if command.page not in mapping:
+                continue
+            command.remap_pages(mapping)
+            commands.append(command)
+            if position < self.index:
+                index += 1
+        self.commands = commands
+        self.index = index
+
+
+# Сколько раскладок текста страниц хранит каждая вкладка
+TEXT_LAYOUT_CACHE_SIZE = 32
+
+
+class TextLayout:
+    """Раскладка символов страницы, извлеченная один раз через get_text("rawdict").
+
+    Символы хранятся в порядке чтения, позиции - в координатах
+    неповернутой страницы, как и аннотации. Строки дополнительно
+    отсортированы по вертикали, а внутри строки известны центры символов,
+    поэтому поиск символа под курсором - два бинарных поиска.
+    """
+
+    def __init__(self, page):
+        self.chars = []  # (x0, y0, x1, y1, c)
+        self.lines = []  # (y0, y1, x0, x1, first, end) - символы строки chars[first:end]
+        self.centers = []  # для каждой строки: x-центры её символов
+        for block in page.get_text("rawdict")["blocks"]:
+            for line in block.get("lines", []):
+                first = len(self.chars)
+                for span in line["spans"]:
+                    for char in span["chars"]:
+                        self.chars.append((*char["bbox"], char["c"]))
+                if len(self.chars) == first:
+                    continue
+                x0, y0, x1, y1 = line["bbox"]
+                self.lines.append((y0, y1, x0, x1, first, len(self.chars)))
+                self.centers.append([(c[0] + c[2]) / 2 for c in self.chars[first:]])
+        
+        # Строки в порядке чтения идут по возрастанию first
+        self.line_starts = [line[4] for line in self.lines]
+        self.by_y = sorted(range(len(self.lines)), key=lambda i: self.lines[i][0])
+        self.y_starts = [self.lines[i][0] for i in self.by_y]
+        self.max_height = max((line[1] - line[0] for line in self.lines), default=0)
+
+    def line_at(self, x, y):
+        """Номер строки под точкой, а если такой нет - ближайшей"""
+        if not self.lines:
+            return None
+        pos = bisect_right(self.y_starts, y)
+        best, best_distance = None, None
+        # Точку могут содержать только строки, начинающиеся не выше y - max_height
+        i = pos - 1
+        while i >= 0 and self.y_starts[i] >= y - self.max_height:
+            y0, y1, x0, x1, _, _ = self.lines[self.by_y[i]]
+            if y <= y1:
+                distance = max(x0 - x, 0, x - x1)
+                if best is None or distance < best_distance:
+                    best, best_distance = self.by_y[i], distance
+            i -= 1
+        if best is not None:
+            return best
+        # Вне строк - ближайшая по вертикали из соседних
+        candidates = [self.by_y[i] for i in (pos - 1, pos) if 0 <= i < len(self.by_y)]
+        return min(candidates, key=lambda n: min(abs(y - self.lines[n][0]), abs(y - self.lines[n][1])))
+
+    def caret_at(self, x, y):
+        """Позиция между символами (индекс в chars), ближайшая к точке"""
+        line_no = self.line_at(x, y)
+        if line_no is None:
+            return 0
+        first = self.lines[line_no][4]
+        return first + bisect_right(self.centers[line_no], x)
+
+    def _line_of(self, index):
+        return bisect_right(self.line_starts, index) - 1
+
+    def selection_rects(self, start, end):
+        """Прямоугольники выделения символов chars[start:end], по одному на строку"""
+        rects = []
+        if start >= end:
+            return rects
+        for line_no in range(self._line_of(start), self._line_of(end - 1) + 1):
+            y0, y1, _, _, first, last = self.lines[line_no]
+            chars = self.chars[max(first, start):min(last, end)]
+            if chars:
+                rects.append((chars[0][0], y0, chars[-1][2], y1))
+        return rects
+
+    def text(self, start, end):
+        """Текст символов chars[start:end]; строки разделяются переводом строки"""
+        if start >= end:
+            return ""
+        parts = []
+        for line_no in range(self._line_of(start), self._line_of(end - 1) + 1):
+            _, _, _, _, first, last = self.lines[line_no]
+            parts.append("".join(c[4] for c in self.chars[max(first, start):min(last, end)]))
+        return "\n".join(parts)
+
+    def search(self, regex):
+        """Ищет регулярное выражение в тексте страницы.
+
+        Текст собирается по строкам через перевод строки, каждый символ
+        строки соответствует одному элементу chars. Возвращает для каждого
+        совпадения список прямоугольников (по одному на строку).
+        """
+        parts, offsets, position = [], [], 0
+        for _, _, _, _, first, last in self.lines:
+            offsets.append(position)
+            parts.append("".join(c[4] for c in self.chars[first:last]))
+            position += last - first + 1
+        text = "\n".join(parts)
+        
+        def char_index(offset):
+            line_no = bisect_right(offsets, offset) - 1
+            first, last = self.lines[line_no][4], self.lines[line_no][5]
+            return min(first + offset - offsets[line_no], last)
+        
+        matches = []
+        for match in regex.finditer(text):
+            rects = self.selection_rects(char_index(match.start()), char_index(match.end()))
+            if rects:
+                matches.append(rects)
+        return matches
+
+
+class DocumentTab:
+    """Состояние одного открытого документа (вкладки)"""
+
+    _ids = itertools.count()
+
+    def __init__(self, file_path):
+        self.doc_id = next(self._ids)
+        self.file_path = file_path
+        self.doc = fitz.open(file_path)
+        self.current_page = 0
+        self.zoom_factor = 1.0
+        self.annotations = AnnotationStore()
+        self.history = UndoStack(self.annotations)
+        # Ключ - xref страницы: раскладка переживает перестановку и поворот
+        self.text_layouts = OrderedDict()
+
+    def text_layout(self, page_num):
+        """Раскладка текста страницы; текст извлекается только при первом обращении"""
+        xref = self.doc.page_xref(page_num)
+        layout = self.text_layouts.get(xref)
+        if layout is None:
+            layout = self.text_layouts[xref] = TextLayout(self.doc[page_num])
+            if len(self.text_layouts) > TEXT_LAYOUT_CACHE_SIZE:
+                self.text_layouts.popitem(last=False)
+        else:
+            self.text_layouts.move_to_end(xref)
+        return layout
+
+    def detach(self):
+        """Переносит документ в память и закрывает его файл, чтобы файл
+        можно было перезаписать. Номера объектов (xref) сохраняются.
+        """
+        if self.doc is not None and self.doc.name:
+            doc = fitz.open(stream=self.doc.tobytes())
+            self.doc.close()
+            self.doc = doc
+
+    def close(self):
+        """Закрывает документ и освобождает его файловый дескриптор"""
+        if self.doc is not None:
+            self.doc.close()
+            self.doc = None
+
+
+# Оптимизация при сохранении: изображения с разрешением выше целевого
+# пересжимаются в JPEG с уменьшением до целевого разрешения
+OPTIMIZE_TARGET_DPI = 150
+OPTIMIZE_JPEG_QUALITY = 80
+
+
+def downsample_image(job):
+    """Уменьшает одно изображение; выполняется в процессе пула.
+
+    job: (xref, image_bytes, width, height, quality). Возвращает
+    (xref, jpeg_bytes) или (xref, None), если выигрыша по размеру нет
+    или изображение не удалось разобрать - тогда оно остается как есть.
+    """
+    xref, data, width, height, quality = job
+    try:
+        pix = fitz.Pixmap(data)
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)
+        if pix.n not in (1, 3):
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        pix = fitz.Pixmap(pix, width, height, None)
+        out = pix.tobytes("jpeg", jpg_quality=quality)
+    except Exception:
+        return xref, None
+    return xref, out if len(out) < len(data) else None
+
+
+def image_jobs(doc, target_dpi, quality):
+    """Задания на уменьшение для изображений документа выше target_dpi.
+
+    Разрешение считается по самому крупному размещению изображения на
+    страницах, чтобы ни одно из размещений не опустилось ниже целевого.
+    Выдает (номер страницы, задание) по одному, не держа все изображения в памяти.
+    """
+    seen = set()
+    for page in doc:
+        for xref, smask, width, height, bpc, *_ in page.get_images(full=True):
+            # Прозрачность (SMask) и двухцветные сканы оставляем как есть
+            if xref in seen or smask or bpc < 8:
+                continue
+            seen.add(xref)
+            rects = page.get_image_rects(xref)
+            if not rects:
+                continue
+            widest = max(rect.width for rect in rects)
+            tallest = max(rect.height for rect in rects)
+            if widest <= 0 or tallest <= 0:
+                continue
+            dpi = min(width * 72 / widest, height * 72 / tallest)
+            if dpi <= target_dpi:
+                continue
+            ratio = target_dpi / dpi
+            new_size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+            data = doc.extract_image(xref)["image"]
+            yield page.number, (xref, data, *new_size, quality)
+
+
+def optimize_images(doc, target_dpi=OPTIMIZE_TARGET_DPI, quality=OPTIMIZE_JPEG_QUALITY,
+                    workers=None):
+    """Уменьшает изображения документа в пуле процессов и заменяет их в doc.
+
+    Одновременно в работе держится не больше двух заданий на процесс, так
+    что память не растет с числом изображений. Возвращает число замен.
+    """
+    replaced = 0
+    pages = {}
+    workers = workers or os.cpu_count() or 1
+    limit = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        jobs = image_jobs(doc, target_dpi, quality)
+        while True:
+            for page_num, job in itertools.islice(jobs, limit - len(pending)):
+                pages[job[0]] = page_num
+                pending.add(pool.submit(downsample_image, job))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                xref, data = future.result()
+                if data is not None:
+                    doc[pages[xref]].replace_image(xref, stream=data)
+                    replaced += 1
+    return replaced
+
+
+def optimize_pdf(source, file_path, target_dpi=OPTIMIZE_TARGET_DPI,
+                 quality=OPTIMIZE_JPEG_QUALITY, workers=None, source_size=None):
+    """Сохраняет оптимизированную копию PDF.
+
+    source - путь к файлу или содержимое PDF в bytes. Изображения выше
+    target_dpi уменьшаются, потоки пересжимаются, объекты упаковываются
+    в объектные потоки, неиспользуемые объекты удаляются. Возвращает отчет:
+    размер до и после, число уменьшенных изображений и время работы.
+    Для bytes размер "до" - source_size (размер исходного файла на диске),
+    если он передан, иначе длина source.
+    """
+    start = time.perf_counter()
+    if isinstance(source, bytes):
+        doc = fitz.open("pdf", source)
+        bytes_before = source_size if source_size is not None else len(source)
+    else:
+        doc = fitz.open(source)
+        bytes_before = os.path.getsize(source)
+    
+    try:
+        images = optimize_images(doc, target_dpi, quality, workers)
+        doc.save(file_path, garbage=4, deflate=True, deflate_images=True,
+                 deflate_fonts=True, clean=True, use_objstms=1)
+    finally:
+        doc.close()
+    
+    return {
+        'file': file_path,
+        'bytes_before': bytes_before,
+        'bytes_after': os.path.getsize(file_path),
+        'images': images,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def format_optimize_report(report):
+    saved = report['bytes_before'] - report['bytes_after']
+    percent = 100 * saved / report['bytes_before'] if report['bytes_before'] else 0
+    return (f"{os.path.basename(report['file'])}: "
+            f"{report['bytes_before'] / 1048576:.1f} MB -> {report['bytes_after'] / 1048576:.1f} MB, "
+            f"saved {saved / 1048576:.1f} MB ({percent:.0f}%), "
+            f"{report['images']} image(s) downsampled in {report['seconds']:.1f} s")
+
+
+def find_pattern_areas(job):
+    """Ищет шаблоны на диапазоне страниц; выполняется в процессе пула.
+
+    job: (путь к PDF, номера страниц, шаблоны). Возвращает
+    (число просмотренных страниц, {страница: [область, ...]}), где область -
+    список прямоугольников одного совпадения.
+    """
+    path, page_numbers, patterns = job
+    regexes = [re.compile(pattern) for pattern in patterns]
+    found = {}
+    with fitz.open(path) as doc:
+        for page_num in page_numbers:
+            layout = TextLayout(doc[page_num])
+            areas = [rects for regex in regexes for rects in layout.search(regex)]
+            if areas:
+                found[page_num] = areas
+    return len(page_numbers), found
+
+
+def search_redactions(path, patterns, workers=None, progress=None):
+    """Ищет шаблоны (регулярные выражения) на всех страницах в пуле процессов.
+
+    Страницы делятся на порции по несколько на процесс. progress(done, total)
+    вызывается по мере готовности порций; если он вернет False, поиск
+    прерывается и функция возвращает None.
+    """
+    with fitz.open(path) as doc:
+        total = len(doc)
+    workers = workers or os.cpu_count() or 1
+    chunk = max(1, math.ceil(total / (workers * 4)))
+    jobs = [(path, range(first, min(first + chunk, total)), patterns)
+            for first in range(0, total, chunk)]
+    
+    found, done = {}, 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(find_pattern_areas, job) for job in jobs]
+        for future in as_completed(futures):
+            pages_done, areas = future.result()
+            found.update(areas)
+            done += pages_done
+            if progress is not None and progress(done, total) is False:
+                for pending in futures:
+                    pending.cancel()
+                return None
+    return found
+
+
+def redact_page(page, areas):
+    """Удаляет содержимое страницы под областями и возвращает число областей.
+
+    Через аннотации Redact и apply_redactions из страницы действительно
+    удаляются текст, пиксели изображений и графика под областями, а не
+    просто закрашиваются сверху.
+    """
+    for rects in areas:
+        for rect in rects:
+            page.add_redact_annot(fitz.Rect(rect), fill=(0, 0, 0))
+    page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_PIXELS)
+    return len(areas)
+
+
+def redact_pdf(source, file_path, patterns, workers=None, progress=None):
+    """Вымарывает все совпадения шаблонов в PDF и сохраняет результат.
+
+    Возвращает {номер страницы: число удаленных областей}. Если поиск
+    прерван через progress, файл не записывается и возвращается None.
+    """
+    found = search_redactions(source, patterns, workers, progress)
+    if found is None:
+        return None
+    counts = {}
+    with fitz.open(source) as doc:
+        for page_num in sorted(found):
+            counts[page_num] = redact_page(doc[page_num], found[page_num])
+        doc.save(file_path, garbage=3, deflate=True)
+    return counts
+
+
+def format_redaction_report(counts):
+    if not counts:
+        return "Nothing to redact."
+    pages = ", ".join(f"p.{page_num + 1}: {count}" for page_num, count in sorted(counts.items())[:20])
+    more = " ..." if len(counts) > 20 else ""
+    return (f"Removed {sum(counts.values())} item(s) on {len(counts)} page(s).\n"
+            f"{pages}{more}")
+
+
+# Экспорт страниц в изображения: формат -> расширение файлов
+EXPORT_FORMATS = {'png': '.png', 'jpeg': '.jpg', 'tiff': '.tif'}
+EXPORT_COLORSPACES = {'rgb': fitz.csRGB, 'gray': fitz.csGRAY}
+
+
+def export_page_files(job):
+    """Рендерит страницы в отдельные файлы; выполняется в процессе пула.
+
+    job: (путь к PDF, номера страниц, dpi, цветовое пространство, формат,
+    шаблон имени файла с полем {page}). Каждая страница сразу пишется на
+    диск, в памяти процесса одновременно держится один растр.
+    """
+    path, page_numbers, dpi, colorspace, fmt, name_pattern = job
+    with fitz.open(path) as doc:
+        for page_num in page_numbers:
+            pix = doc[page_num].get_pixmap(dpi=dpi, colorspace=EXPORT_COLORSPACES[colorspace],
+                                           alpha=False)
+            file_name = name_pattern.format(page=page_num + 1)
+            if fmt == 'jpeg':
+                pix.save(file_name, jpg_quality=90)
+            else:
+                pix.save(file_name)
+    return list(page_numbers)
+
+
+def export_pages(source, file_path, pages=None, dpi=300, colorspace='rgb', fmt='png',
+                 workers=None, progress=None):
+    """Экспортирует страницы PDF в изображения в пуле процессов.
+
+    Для png/jpeg каждая страница пишется в свой файл рядом с file_path
+    (name-0001.png, ...), для tiff - все страницы в один многостраничный
+    file_path; для этого страницы сначала пишутся во временные PNG и по
+    порядку дописываются в TIFF, так что память не растет с числом страниц.
+    progress(done, total) вызывается по мере готовности; если он вернет
+    False, экспорт прерывается. Возвращает отчет: число страниц, время и
+    скорость в страницах в секунду.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if fmt == 'tiff':
+        try:
+            from PIL import Image, TiffImagePlugin
+        except ImportError:
+            raise RuntimeError("Multi-page TIFF export requires Pillow (pip install Pillow)")
+    
+    start = time.perf_counter()
+    with fitz.open(source) as doc:
+        pages = list(range(len(doc))) if pages is None else list(pages)
+    
+    base, _ = os.path.splitext(file_path)
+    temp_dir = tempfile.mkdtemp() if fmt == 'tiff' else None
+    if temp_dir:
+        name_pattern = os.path.join(temp_dir, "{page:06d}.png")
+        render_fmt = 'png'
+    else:
+        name_pattern = base + "-{page:04d}" + EXPORT_FORMATS[fmt]
+        render_fmt = fmt
+    
+    workers = workers or os.cpu_count() or 1
+    chunk = max(1, math.ceil(len(pages) / (workers * 4)))
+    jobs = [(source, pages[i:i + chunk], dpi, colorspace, render_fmt, name_pattern)
+            for i in range(0, len(pages), chunk)]
+    
+    done = 0
+    cancelled = False
+    writer = TiffImagePlugin.AppendingTiffWriter(file_path, True) if temp_dir else None
+    try:
+        rendered = set()
+        next_page = 0  # индекс в pages следующей страницы для TIFF
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(export_page_files, job) for job in jobs]
+            for future in as_completed(futures):
+                finished = future.result()
+                done += len(finished)
+                if writer is not None:
+                    # Дописываем страницы строго по порядку, как только они готовы
+                    rendered.update(finished)
+                    while next_page < len(pages) and pages[next_page] in rendered:
+                        page_file = name_pattern.format(page=pages[next_page] + 1)
+                        with Image.open(page_file) as image:
+                            image.save(writer, format="TIFF", compression="tiff_deflate")
+                        writer.newFrame()
+                        os.remove(page_file)
+                        next_page += 1
+                if progress is not None and progress(done, len(pages)) is False:
+                    cancelled = True
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    finally:
+        if writer is not None:
+            writer.close()
+        if temp_dir:
+            for name in os.listdir(temp_dir):
+                os.remove(os.path.join(temp_dir, name))
+            os.rmdir(temp_dir)
+    
+    seconds = time.perf_counter() - start
+    return {
+        'pages': done,
+        'cancelled': cancelled,
+        'seconds': seconds,
+        'pages_per_second': done / seconds if seconds else 0,
+    }
+
+
 class PDFViewer(QMainWindow):
     def __init__(self):
         super().__init__()
         # Инициализируем атрибуты перед вызовом initUI
-        self.current_file = None
-        self.doc = None
-        self.current_page = 0
-        self.zoom_factor = 1.0
+        self.tabs = []
+        self.tab = None
         self.drawing = False
-        self.last_point = QPoint()
-        self.annotations = []
-        self.current_tool = "pan"  # "pan", "pencil", "text"
+        self.active_stroke = None
+        self.selected_annotation = None
+        # Перетаскиваемая аннотация: {'ann', 'index', 'start', 'offset'}
+        self.moving = None
+        # Выделение текста: {'page', 'anchor', 'caret', 'rects'}
+        self.text_selection = None
+        self.last_point = QPointF()
+        self.current_tool = "pan"  # "pan", "pencil", "text", "select", "erase", "move", "select_text"
         self.pen_color = QColor(255, 0, 0)
         self.pen_width = 3
-        self.text_annotations = []
         self.original_pixmap = None
+        # Преобразование из координат страницы PDF в пиксели отображения
+        self.page_transform = QTransform()
+        self.page_bounds = QRectF()
+        # Страница с нарисованными аннотациями и ключ, для которого она собрана
+        self.page_overlay = None
+        self.page_overlay_key = None
+        self.screen_tracked = False
         
         self.initUI()
+
+    # Состояние документа хранится во вкладке, окно лишь ссылается на активную
+    @property
+    def doc(self):
+        return self.tab.doc if self.tab else None
+
+    @property
+    def current_file(self):
+        return self.tab.file_path if self.tab else None
+
+    @property
+    def current_page(self):
+        return self.tab.current_page if self.tab else 0
+
+    @current_page.setter
+    def current_page(self, value):
+        self.tab.current_page = value
+
+    @property
+    def zoom_factor(self):
+        return self.tab.zoom_factor if self.tab else 1.0
+
+    @zoom_factor.setter
+    def zoom_factor(self, value):
+        if self.tab:
+            self.tab.zoom_factor = value
+
+    @property
+    def annotations(self):
+        return self.tab.annotations if self.tab else None
+
+    @property
+    def history(self):
+        return self.tab.history if self.tab else None
         
     def initUI(self):
         self.setWindowTitle("PDF Viewer with Annotations")
@@ -81,6 +1032,26 @@ class PDFViewer(QMainWindow):
         text_btn.clicked.connect(lambda: self.set_tool("text"))
         sidebar_layout.addWidget(text_btn)
         
+        select_btn = QPushButton("Select")
+        select_btn.clicked.connect(lambda: self.set_tool("select"))
+        sidebar_layout.addWidget(select_btn)
+        
+        move_btn = QPushButton("Move")
+        move_btn.clicked.connect(lambda: self.set_tool("move"))
+        sidebar_layout.addWidget(move_btn)
+        
+        erase_btn = QPushButton("Eraser")
+        erase_btn.clicked.connect(lambda: self.set_tool("erase"))
+        sidebar_layout.addWidget(erase_btn)
+        
+        select_text_btn = QPushButton("Select Text")
+        select_text_btn.clicked.connect(lambda: self.set_tool("select_text"))
+        sidebar_layout.addWidget(select_text_btn)
+        
+        redact_btn = QPushButton("Redact Area")
+        redact_btn.clicked.connect(lambda: self.set_tool("redact"))
+        sidebar_layout.addWidget(redact_btn)
+        
         # Color selection
         color_btn = QPushButton("Choose Color")
         color_btn.clicked.connect(self.choose_color)
@@ -106,6 +1077,36 @@ class PDFViewer(QMainWindow):
         clear_btn.clicked.connect(self.clear_annotations)
         sidebar_layout.addWidget(clear_btn)
         
+        # Pages list: drag to reorder, multi-select for bulk operations
+        sidebar_layout.addWidget(QLabel("Pages:"))
+        self.page_list = QListWidget()
+        self.page_list.setUniformItemSizes(True)
+        self.page_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.page_list.setDragDropMode(QAbstractItemView.InternalMove)
+        self.page_list.currentRowChanged.connect(lambda row: self.go_to_page(row + 1))
+        # Одно перетаскивание может дать несколько rowsMoved - применяем порядок
+        # страниц один раз, после того как список закончит обработку drop
+        self.page_list.model().rowsMoved.connect(
+            lambda *args: QTimer.singleShot(0, self.apply_page_list_order))
+        sidebar_layout.addWidget(self.page_list)
+        
+        page_ops_layout = QHBoxLayout()
+        rotate_left_btn = QPushButton("⟲")
+        rotate_left_btn.setToolTip("Rotate Left")
+        rotate_left_btn.clicked.connect(lambda: self.rotate_pages(-90))
+        page_ops_layout.addWidget(rotate_left_btn)
+        
+        rotate_right_btn = QPushButton("⟳")
+        rotate_right_btn.setToolTip("Rotate Right")
+        rotate_right_btn.clicked.connect(lambda: self.rotate_pages(90))
+        page_ops_layout.addWidget(rotate_right_btn)
+        
+        delete_pages_btn = QPushButton("Delete")
+        delete_pages_btn.setToolTip("Delete Pages")
+        delete_pages_btn.clicked.connect(self.delete_pages)
+        page_ops_layout.addWidget(delete_pages_btn)
+        sidebar_layout.addLayout(page_ops_layout)
+        
         sidebar_layout.addStretch()
         parent.addWidget(sidebar_widget)
         
@@ -113,6 +1114,14 @@ class PDFViewer(QMainWindow):
         main_widget = QWidget()
         main_layout = QVBoxLayout(main_widget)
         
+        # Document tabs
+        self.tab_bar = QTabBar()
+        self.tab_bar.setTabsClosable(True)
+        self.tab_bar.setExpanding(False)
+        self.tab_bar.currentChanged.connect(self.tab_changed)
+        self.tab_bar.tabCloseRequested.connect(self.close_tab)
+        main_layout.addWidget(self.tab_bar)
+        
         # Navigation controls
         nav_layout = QHBoxLayout()
         
@@ -198,6 +1207,20 @@ class PDFViewer(QMainWindow):
         save_action.triggered.connect(self.save_file)
         file_menu.addAction(save_action)
         
+        self.optimize_action = QAction(f'Optimize on Save ({OPTIMIZE_TARGET_DPI} DPI)', self)
+        self.optimize_action.setCheckable(True)
+        file_menu.addAction(self.optimize_action)
+        
+        export_action = QAction('Export Images...', self)
+        export_action.setShortcut('Ctrl+E')
+        export_action.triggered.connect(self.export_images)
+        file_menu.addAction(export_action)
+        
+        close_action = QAction('Close', self)
+        close_action.setShortcut('Ctrl+W')
+        close_action.triggered.connect(lambda: self.close_tab(self.tab_bar.currentIndex()))
+        file_menu.addAction(close_action)
+        
         file_menu.addSeparator()
         
         print_action = QAction('Print', self)
@@ -212,6 +1235,38 @@ class PDFViewer(QMainWindow):
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
         
+        # Edit menu
+        edit_menu = menubar.addMenu('Edit')
+        
+        undo_action = QAction('Undo', self)
+        undo_action.setShortcut('Ctrl+Z')
+        undo_action.triggered.connect(self.undo)
+        edit_menu.addAction(undo_action)
+        
+        redo_action = QAction('Redo', self)
+        redo_action.setShortcuts(['Ctrl+Y', 'Ctrl+Shift+Z'])
+        redo_action.triggered.connect(self.redo)
+        edit_menu.addAction(redo_action)
+        
+        edit_menu.addSeparator()
+        
+        delete_action = QAction('Delete Annotation', self)
+        delete_action.setShortcut('Del')
+        delete_action.triggered.connect(self.delete_selected_annotation)
+        edit_menu.addAction(delete_action)
+        
+        edit_menu.addSeparator()
+        
+        copy_action = QAction('Copy Text', self)
+        copy_action.setShortcut('Ctrl+C')
+        copy_action.triggered.connect(self.copy_selected_text)
+        edit_menu.addAction(copy_action)
+        
+        highlight_action = QAction('Highlight Selection', self)
+        highlight_action.setShortcut('Ctrl+H')
+        highlight_action.triggered.connect(self.highlight_selected_text)
+        edit_menu.addAction(highlight_action)
+        
         # View menu
         view_menu = menubar.addMenu('View')
         
@@ -230,6 +1285,48 @@ class PDFViewer(QMainWindow):
         reset_zoom_action.triggered.connect(self.reset_zoom)
         view_menu.addAction(reset_zoom_action)
         
+        # Pages menu
+        pages_menu = menubar.addMenu('Pages')
+        
+        rotate_left_action = QAction('Rotate Left', self)
+        rotate_left_action.setShortcut('Ctrl+L')
+        rotate_left_action.triggered.connect(lambda: self.rotate_pages(-90))
+        pages_menu.addAction(rotate_left_action)
+        
+        rotate_right_action = QAction('Rotate Right', self)
+        rotate_right_action.setShortcut('Ctrl+R')
+        rotate_right_action.triggered.connect(lambda: self.rotate_pages(90))
+        pages_menu.addAction(rotate_right_action)
+        
+        delete_pages_action = QAction('Delete Pages', self)
+        delete_pages_action.triggered.connect(self.delete_pages)
+        pages_menu.addAction(delete_pages_action)
+        
+        pages_menu.addSeparator()
+        
+        extract_action = QAction('Extract Pages...', self)
+        extract_action.triggered.connect(self.extract_pages)
+        pages_menu.addAction(extract_action)
+        
+        insert_pdf_action = QAction('Insert PDF...', self)
+        insert_pdf_action.triggered.connect(self.insert_pdf)
+        pages_menu.addAction(insert_pdf_action)
+        
+        # Redaction menu
+        redaction_menu = menubar.addMenu('Redaction')
+        
+        redact_area_action = QAction('Mark Area', self)
+        redact_area_action.triggered.connect(lambda: self.set_tool("redact"))
+        redaction_menu.addAction(redact_area_action)
+        
+        redact_pattern_action = QAction('Redact by Pattern...', self)
+        redact_pattern_action.triggered.connect(self.redact_by_pattern)
+        redaction_menu.addAction(redact_pattern_action)
+        
+        apply_redactions_action = QAction('Apply Redactions', self)
+        apply_redactions_action.triggered.connect(lambda: self.apply_redactions())
+        redaction_menu.addAction(apply_redactions_action)
+        
     def create_toolbar(self):
         toolbar = QToolBar("Main Toolbar")
         self.addToolBar(toolbar)
@@ -253,24 +1350,70 @@ class PDFViewer(QMainWindow):
         toolbar.addAction(zoom_out_btn)
         
     def open_file(self):
-        file_path, _ = QFileDialog.getOpenFileName(self, "Open PDF File", "", "PDF Files (*.pdf)")
-        
-        if file_path:
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "Open PDF Files", "", "PDF Files (*.pdf)")
+        
+        for file_path in file_paths:
+            # Уже открытый файл просто делаем активным
+            opened = [i for i, tab in enumerate(self.tabs) if tab.file_path == file_path]
+            if opened:
+                self.tab_bar.setCurrentIndex(opened[0])
+                continue
             try:
-                self.doc = fitz.open(file_path)
-                self.current_file = file_path
-                self.current_page = 0
-                self.zoom_factor = 1.0
-                self.zoom_slider.setValue(100)
-                self.annotations = []
-                self.text_annotations = []
-                self.update_annotations_list()
-                self.update_page_controls()
-                self.display_page()
+                tab = DocumentTab(file_path)
+                self.tabs.append(tab)
+                index = self.tab_bar.addTab(os.path.basename(file_path))
+                self.tab_bar.setTabToolTip(index, file_path)
+                self.tab_bar.setCurrentIndex(index)
                 self.statusBar().showMessage(f"Opened: {os.path.basename(file_path)}")
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Could not open file: {str(e)}")
     
+    def tab_changed(self, index):
+        # Перетаскиваемая аннотация возвращается в хранилище прежней вкладки
+        self.cancel_moving()
+        self.tab = self.tabs[index] if 0 <= index < len(self.tabs) else None
+        self.original_pixmap = None
+        self.page_overlay_key = None
+        self.drawing = False
+        self.active_stroke = None
+        self.selected_annotation = None
+        self.text_selection = None
+        
+        # Восстанавливаем масштаб вкладки без повторной перерисовки
+        self.zoom_slider.blockSignals(True)
+        self.zoom_slider.setValue(int(round(self.zoom_factor * 100)))
+        self.zoom_slider.blockSignals(False)
+        self.zoom_label.setText(f"{self.zoom_slider.value()}%")
+        
+        self.refresh_page_list()
+        self.update_annotations_list()
+        self.update_page_controls()
+        if self.doc:
+            self.display_page()
+        else:
+            self.pdf_label.clear()
+    
+    def close_tab(self, index):
+        if not 0 <= index < len(self.tabs):
+            return
+        
+        tab = self.tabs.pop(index)
+        if tab is self.tab:
+            self.tab = None
+        render_cache.evict_document(tab.doc_id)
+        tab.close()
+        # Возвращаем системе память, занятую хранилищем ресурсов MuPDF
+        fitz.TOOLS.store_shrink(100)
+        
+        self.tab_bar.removeTab(index)
+        if not self.tabs:
+            self.tab_changed(-1)
+    
+    def closeEvent(self, event):
+        while self.tabs:
+            self.close_tab(len(self.tabs) - 1)
+        super().closeEvent(event)
+    
     def save_file(self):
         if not self.doc:
             QMessageBox.warning(self, "Warning", "No PDF file is open.")
@@ -280,105 +1423,464 @@ class PDFViewer(QMainWindow):
         
         if file_path:
             try:
-                # Apply annotations to the PDF
-                self.apply_annotations_to_pdf()
-                self.doc.save(file_path)
-                self.statusBar().showMessage(f"Saved as: {os.path.basename(file_path)}")
-                QMessageBox.information(self, "Success", "File saved successfully.")
+                # Записывается копия с аннотациями и вымаранными областями;
+                # открытый документ, его история и отметки не меняются
+                data = self.output_pdf_bytes()
+                if self.doc.name and os.path.abspath(file_path) == os.path.abspath(self.doc.name):
+                    # Файл открытого документа перезаписывается только отпущенным
+                    self.tab.detach()
+                if self.optimize_action.isChecked():
+                    # Оптимизируется копия: открытый документ сохраняет полное качество
+                    # Выигрыш считается от исходного файла на диске, а не от копии
+                    source_size = (os.path.getsize(self.current_file)
+                                   if os.path.exists(self.current_file) else None)
+                    QApplication.setOverrideCursor(Qt.WaitCursor)
+                    try:
+                        report = optimize_pdf(data, file_path, source_size=source_size)
+                    finally:
+                        QApplication.restoreOverrideCursor()
+                    self.statusBar().showMessage(format_optimize_report(report))
+                    QMessageBox.information(self, "Success",
+                                            f"File saved successfully.\n\n{format_optimize_report(report)}")
+                else:
+                    with open(file_path, "wb") as f:
+                        f.write(data)
+                    self.statusBar().showMessage(f"Saved as: {os.path.basename(file_path)}")
+                    QMessageBox.information(self, "Success", "File saved successfully.")
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Could not save file: {str(e)}")
     
-    def apply_annotations_to_pdf(self):
-        """Apply drawings and text annotations to the PDF document"""
+    def export_images(self):
         if not self.doc:
+            QMessageBox.warning(self, "Warning", "No PDF file is open.")
+            return
+        
+        filters = {"PNG Images (*.png)": 'png', "JPEG Images (*.jpg)": 'jpeg',
+                   "Multi-page TIFF (*.tif)": 'tiff'}
+        file_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Export Pages", "", ";;".join(filters))
+        if not file_path:
+            return
+        fmt = filters.get(selected_filter, 'png')
+        if not os.path.splitext(file_path)[1]:
+            file_path += EXPORT_FORMATS[fmt]
+        
+        dpi, ok = QInputDialog.getInt(self, "Export Pages", "Resolution (DPI):", 300, 36, 1200)
+        if not ok:
+            return
+        colorspace, ok = QInputDialog.getItem(self, "Export Pages", "Color:", ["RGB", "Gray"], 0, False)
+        if not ok:
             return
-            
-        # For this example, we'll just save the original PDF
-        # In a real implementation, you would use PyMuPDF to add annotations
-        # to the PDF pages based on the drawings and text
         
-        # This is a placeholder for the annotation logic
-        print("Applying annotations to PDF...")
+        # Выбранные в списке страницы, иначе весь документ
+        rows = sorted(index.row() for index in self.page_list.selectedIndexes())
+        if rows:
+            choices = [f"Selected pages ({len(rows)})", f"All pages ({len(self.doc)})"]
+            choice, ok = QInputDialog.getItem(self, "Export Pages", "Pages:", choices, 0, False)
+            if not ok:
+                return
+            if choice == choices[1]:
+                rows = []
+        pages = rows or None
+        total = len(rows) if pages else len(self.doc)
+        
+        progress = QProgressDialog("Exporting pages...", "Cancel", 0, total, self)
+        progress.setWindowTitle("Export")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+        
+        def report(done, total):
+            progress.setValue(done)
+            QApplication.processEvents()
+            return not progress.wasCanceled()
+        
+        # Процессы пула читают копию документа на диске вместе с аннотациями;
+        # отмеченные области вымарываются только в этой копии
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            with open(path, "wb") as f:
+                f.write(self.output_pdf_bytes())
+            result = export_pages(path, file_path, pages, dpi, colorspace.lower(), fmt,
+                                  progress=report)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Could not export pages: {str(e)}")
+            return
+        finally:
+            progress.close()
+            os.remove(path)
+        
+        message = (f"Exported {result['pages']} page(s) in {result['seconds']:.1f} s "
+                   f"({result['pages_per_second']:.1f} pages/s)")
+        if result['cancelled']:
+            message += " - cancelled"
+        self.statusBar().showMessage(message)
+        QMessageBox.information(self, "Export", message)
+    
+    def apply_annotations_to_pdf(self):
+        """Apply drawings and text annotations to the PDF document as real PDF annotations"""
+        added = []
+        if not self.doc:
+            return added
+        
+        for ann in self.annotations:
+            page = self.doc[ann['page']]
+            if ann['type'] == 'pencil':
+                if len(ann['points']) < 2:
+                    continue
+                annot = page.add_ink_annot([ann['points']])
+                annot.set_colors(stroke=ann['color'].getRgbF()[:3])
+                annot.set_border(width=ann['width'])
+                annot.update()
+            elif ann['type'] == 'text':
+                x, y = ann['position'].x(), ann['position'].y()
+                # Позиция аннотации - базовая линия текста, как у QPainter.drawText
+                width = fitz.get_text_length(ann['text'], fontsize=12) + 4
+                rect = fitz.Rect(x, y - 14, x + width, y + 4)
+                annot = page.add_freetext_annot(rect, ann['text'], fontsize=12,
+                                                text_color=ann['color'].getRgbF()[:3])
+            elif ann['type'] == 'highlight':
+                annot = page.add_highlight_annot(quads=[fitz.Rect(r).quad for r in ann['rects']])
+                annot.set_colors(stroke=ann['color'].getRgbF()[:3])
+                annot.update()
+            else:
+                continue
+            added.append((ann['page'], annot.xref))
+        
+        return added
+    
+    def output_pdf_bytes(self):
+        """Содержимое PDF для записи: аннотации и вымаранные отмеченные области.
+
+        Аннотации временно добавляются в открытый документ, отмеченные
+        области вымарываются уже в копии, так что открытый документ
+        остается прежним.
+        """
+        added = self.apply_annotations_to_pdf()
+        try:
+            # garbage=1 выбрасывает объекты удаленных страниц, не перенумеровывая
+            # остальные: кэш рендера открытого документа привязан к xref страниц
+            data = self.doc.tobytes(garbage=1)
+        finally:
+            # Аннотации остаются редактируемыми, в открытом документе их не держим
+            self.remove_pdf_annotations(added)
+        
+        areas = {}
+        for ann in self.annotations:
+            if ann['type'] == 'redact':
+                areas.setdefault(ann['page'], []).append([ann['rect']])
+        if not areas:
+            return data
+        with fitz.open("pdf", data) as doc:
+            for page_num, page_areas in areas.items():
+                redact_page(doc[page_num], page_areas)
+            return doc.tobytes(garbage=3, deflate=True)
+    
+    def remove_pdf_annotations(self, added):
+        """Удаляет из документа аннотации, добавленные apply_annotations_to_pdf"""
+        for page_num, xref in added:
+            page = self.doc[page_num]
+            annot = page.load_annot(xref)
+            if annot:
+                page.delete_annot(annot)
     
     def display_page(self):
         if not self.doc:
             return
             
         try:
-            page = self.doc[self.current_page]
-            mat = fitz.Matrix(self.zoom_factor, self.zoom_factor)
-            pix = page.get_pixmap(matrix=mat)
-            
-            img_data = pix.tobytes("ppm")
-            image = QImage()
-            image.loadFromData(img_data)
-            
-            # Сохраняем оригинальное изображение для масштабирования
-            self.original_pixmap = QPixmap.fromImage(image)
-            
-            # Создаем QPixmap с фиксированным размером контейнера
+            # Слой аннотаций пересобирается, только если изменилась сама страница
             container_size = self.scroll_area.viewport().size()
-            scaled_pixmap = self.original_pixmap.scaled(
-                container_size, 
-                Qt.KeepAspectRatio, 
-                Qt.SmoothTransformation
-            )
-            
-            # Создаем временный pixmap для рисования аннотаций
-            temp_pixmap = QPixmap(scaled_pixmap.size())
-            temp_pixmap.fill(Qt.white)
+            overlay_key = (self.tab.doc_id, self.current_page,
+                           self.annotations.revision(self.current_page),
+                           self.zoom_factor, container_size.width(), container_size.height(),
+                           self.devicePixelRatioF())
+            if overlay_key != self.page_overlay_key:
+                self.page_overlay = self.compose_page(container_size)
+                self.page_overlay_key = overlay_key
             
-            painter = QPainter(temp_pixmap)
+            pixmap = self.page_overlay
+            selected = self.selected_annotation
+            if selected is not None and selected['page'] != self.current_page:
+                selected = None
+            text_selection = self.text_selection
+            if text_selection is not None and text_selection['page'] != self.current_page:
+                text_selection = None
+            if (self.active_stroke is not None or self.moving is not None or
+                    selected is not None or text_selection is not None):
+                # Рисуемый штрих, перетаскиваемая аннотация, рамка выделения
+                # и выделенный текст накладываются поверх готового слоя страницы
+                pixmap = QPixmap(self.page_overlay)
+                painter = QPainter(pixmap)
+                painter.setRenderHint(QPainter.Antialiasing)
+                painter.setTransform(self.page_transform)
+                if text_selection is not None:
+                    for x0, y0, x1, y1 in text_selection['rects']:
+                        painter.fillRect(QRectF(x0, y0, x1 - x0, y1 - y0), QColor(0, 120, 215, 80))
+                if self.active_stroke is not None:
+                    self.draw_annotation(painter, self.active_stroke)
+                if self.moving is not None:
+                    offset = self.moving['offset']
+                    painter.translate(offset)
+                    self.draw_annotation(painter, self.moving['ann'])
+                    if self.moving['ann'] is selected:
+                        self.draw_selection(painter, selected)
+                    painter.translate(-offset)
+                elif selected is not None:
+                    self.draw_selection(painter, selected)
+                painter.end()
             
-            # Рисуем масштабированное изображение PDF
-            painter.drawPixmap(0, 0, scaled_pixmap)
-            
-            # Масштабируем координаты аннотаций
-            scale_x = scaled_pixmap.width() / self.original_pixmap.width()
-            scale_y = scaled_pixmap.height() / self.original_pixmap.height()
-            
-            # Draw pencil annotations
-            for annotation in self.annotations:
-                if annotation['page'] == self.current_page and annotation['type'] == 'pencil':
-                    pen = QPen(annotation['color'], annotation['width'] * min(scale_x, scale_y))
-                    painter.setPen(pen)
-                    
-                    scaled_points = []
-                    for point in annotation['points']:
-                        scaled_point = QPoint(int(point.x() * scale_x), int(point.y() * scale_y))
-                        scaled_points.append(scaled_point)
-                    
-                    for i in range(1, len(scaled_points)):
-                        painter.drawLine(scaled_points[i-1], scaled_points[i])
-            
-            # Draw text annotations
-            for text_ann in self.text_annotations:
-                if text_ann['page'] == self.current_page:
-                    font = QFont("Arial", 12 * min(scale_x, scale_y))
-                    painter.setFont(font)
-                    painter.setPen(QPen(text_ann['color']))
-                    
-                    scaled_position = QPoint(
-                        int(text_ann['position'].x() * scale_x),
-                        int(text_ann['position'].y() * scale_y)
-                    )
-                    painter.drawText(scaled_position, text_ann['text'])
-            
-            painter.end()
-            
-            self.pdf_label.setPixmap(temp_pixmap)
+            self.pdf_label.setPixmap(pixmap)
             
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Could not display page: {str(e)}")
     
+    def compose_page(self, container_size):
+        """Рендерит страницу под размер области просмотра вместе с аннотациями.
+
+        Масштаб 100% - страница целиком в области просмотра. Страница
+        рендерится сразу в физических пикселях экрана (масштаб умножен на
+        devicePixelRatio), так что при отрисовке Qt ничего не масштабирует.
+        """
+        page = self.doc[self.current_page]
+        dpr = self.devicePixelRatioF()
+        fit = min(container_size.width() / page.rect.width,
+                  container_size.height() / page.rect.height)
+        # Округление не дает плавному изменению размера окна плодить записи кэша
+        scale = round(fit * self.zoom_factor, 3)
+        
+        # Ключ по xref страницы не меняется при перестановке страниц
+        cache_key = (self.tab.doc_id, page.xref, scale, dpr)
+        self.original_pixmap = render_cache.get(cache_key)
+        
+        if self.original_pixmap is None:
+            mat = fitz.Matrix(scale * dpr, scale * dpr)
+            pix = page.get_pixmap(matrix=mat)
+            
+            image = QImage(pix.samples, pix.width, pix.height, pix.stride,
+                           QImage.Format_RGB888).copy()
+            image.setDevicePixelRatio(dpr)
+            
+            self.original_pixmap = QPixmap.fromImage(image)
+            render_cache.put(cache_key, self.original_pixmap, self.tab.doc_id)
+        
+        # Создаем временный pixmap для рисования аннотаций того же размера
+        temp_pixmap = QPixmap(self.original_pixmap.size())
+        temp_pixmap.setDevicePixelRatio(dpr)
+        temp_pixmap.fill(Qt.white)
+        
+        painter = QPainter(temp_pixmap)
+        
+        # Рисуем изображение PDF один к одному
+        painter.drawPixmap(0, 0, self.original_pixmap)
+        
+        # Аннотации хранятся в координатах неповернутой страницы PDF;
+        # переводим их в логические пиксели одним преобразованием на всю страницу
+        m = page.rotation_matrix * fitz.Matrix(scale, scale)
+        self.page_transform = QTransform(m.a, m.b, m.c, m.d, m.e, m.f)
+        bounds = page.rect * page.derotation_matrix
+        self.page_bounds = QRectF(bounds.x0, bounds.y0, bounds.width, bounds.height)
+        
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setTransform(self.page_transform)
+        
+        for annotation in self.annotations.page(self.current_page):
+            self.draw_annotation(painter, annotation)
+        
+        painter.end()
+        
+        return temp_pixmap
+    
+    def draw_annotation(self, painter, annotation):
+        """Рисует аннотацию; painter уже переведен в координаты страницы"""
+        if annotation['type'] == 'pencil':
+            pen = QPen(annotation['color'], annotation['width'])
+            pen.setCapStyle(Qt.RoundCap)
+            pen.setJoinStyle(Qt.RoundJoin)
+            painter.setPen(pen)
+            painter.drawPath(annotation['path'])
+        elif annotation['type'] == 'text':
+            # Размер в единицах страницы, как у сохраняемой FreeText-аннотации
+            font = QFont("Arial")
+            font.setPixelSize(12)
+            painter.setFont(font)
+            painter.setPen(QPen(annotation['color']))
+            painter.drawText(annotation['position'], annotation['text'])
+        elif annotation['type'] == 'highlight':
+            # Умножение затемняет фон, не закрывая текст, как маркер на бумаге
+            painter.setCompositionMode(QPainter.CompositionMode_Multiply)
+            for x0, y0, x1, y1 in annotation['rects']:
+                painter.fillRect(QRectF(x0, y0, x1 - x0, y1 - y0), annotation['color'])
+            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        elif annotation['type'] == 'redact':
+            # Область до применения: содержимое видно сквозь затемнение
+            x0, y0, x1, y1 = annotation['rect']
+            painter.setPen(QPen(QColor(255, 0, 0), 0))
+            painter.setBrush(QColor(0, 0, 0, 120))
+            painter.drawRect(QRectF(x0, y0, x1 - x0, y1 - y0))
+            painter.setBrush(Qt.NoBrush)
+    
+    def draw_selection(self, painter, annotation):
+        """Рисует пунктирную рамку вокруг выделенной аннотации"""
+        x0, y0, x1, y1 = annotation['bbox']
+        pen = QPen(QColor(0, 120, 215), 0, Qt.DashLine)
+        painter.setPen(pen)
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(QRectF(x0 - 2, y0 - 2, x1 - x0 + 4, y1 - y0 + 4))
+    
     def update_page_controls(self):
         if self.doc:
             total_pages = len(self.doc)
             self.page_label.setText(f"Page: {self.current_page + 1}/{total_pages}")
+            # Синхронизация спинбокса не должна сама переключать страницу
+            self.page_spin.blockSignals(True)
             self.page_spin.setRange(1, total_pages)
             self.page_spin.setValue(self.current_page + 1)
+            self.page_spin.blockSignals(False)
             self.prev_btn.setEnabled(self.current_page > 0)
             self.next_btn.setEnabled(self.current_page < total_pages - 1)
+            self.page_list.blockSignals(True)
+            self.page_list.setCurrentRow(self.current_page, QItemSelectionModel.NoUpdate)
+            self.page_list.blockSignals(False)
+        else:
+            self.page_label.setText("Page: 0/0")
+            self.page_spin.setRange(0, 0)
+            self.prev_btn.setEnabled(False)
+            self.next_btn.setEnabled(False)
+    
+    def refresh_page_list(self):
+        """Заполняет список страниц; в данных элемента - номер страницы"""
+        self.page_list.blockSignals(True)
+        self.page_list.clear()
+        if self.doc:
+            for page_num in range(len(self.doc)):
+                item = QListWidgetItem(f"Page {page_num + 1}")
+                item.setData(Qt.UserRole, page_num)
+                self.page_list.addItem(item)
+        self.page_list.blockSignals(False)
+    
+    def selected_pages(self):
+        """Выбранные в списке страницы, либо текущая страница"""
+        rows = sorted(index.row() for index in self.page_list.selectedIndexes())
+        return rows or [self.current_page]
+    
+    def pages_changed(self, order, removed_xrefs=()):
+        """Переносит состояние вкладки на новый порядок страниц.
+
+        order[new] = old - номер страницы до операции; страницы, не попавшие
+        в order, удалены. Кэш рендера привязан к xref страниц, поэтому
+        из него убираются только удаленные страницы.
+        """
+        self.cancel_moving()
+        mapping = {old: new for new, old in enumerate(order)}
+        self.annotations.remap(mapping)
+        self.history.remap_pages(mapping)
+        render_cache.evict_pages(self.tab.doc_id, removed_xrefs)
+        
+        current = mapping.get(self.current_page)
+        if current is None:
+            current = min(self.current_page, len(self.doc) - 1)
+        self.current_page = max(current, 0)
+        self.page_overlay_key = None
+        self.selected_annotation = None
+        self.text_selection = None
+        
+        self.refresh_page_list()
+        self.update_page_controls()
+        self.update_annotations_list()
+        self.display_page()
+    
+    def apply_page_list_order(self):
+        """Переставляет страницы документа в порядке списка страниц"""
+        if not self.doc or self.page_list.count() != len(self.doc):
+            return
+        order = [self.page_list.item(i).data(Qt.UserRole) for i in range(self.page_list.count())]
+        if order == list(range(len(order))):
+            return
+        
+        moved = single_moved_page(order)
+        if moved is not None:
+            # Одна страница - перемещаем её, не перестраивая дерево страниц целиком
+            self.doc.move_page(*moved)
+        else:
+            self.doc.select(order)
+        self.pages_changed(order)
+        self.statusBar().showMessage("Pages reordered")
+    
+    def rotate_pages(self, angle):
+        if not self.doc:
+            return
+        pages = self.selected_pages()
+        xrefs = []
+        for page_num in pages:
+            page = self.doc[page_num]
+            page.set_rotation((page.rotation + angle) % 360)
+            xrefs.append(page.xref)
+            # Аннотации поворачиваются вместе со страницей; перерисовываем её слой
+            self.annotations.touch(page_num)
+        render_cache.evict_pages(self.tab.doc_id, xrefs)
+        self.display_page()
+        self.statusBar().showMessage(f"Rotated {len(pages)} page(s)")
+    
+    def delete_pages(self):
+        if not self.doc:
+            return
+        pages = self.selected_pages()
+        if len(pages) == len(self.doc):
+            QMessageBox.warning(self, "Warning", "Cannot delete all pages of the document.")
+            return
+        
+        removed = set(pages)
+        xrefs = [self.doc.page_xref(page_num) for page_num in pages]
+        order = [page_num for page_num in range(len(self.doc)) if page_num not in removed]
+        self.doc.delete_pages(pages)
+        self.pages_changed(order, xrefs)
+        self.statusBar().showMessage(f"Deleted {len(pages)} page(s)")
+    
+    def extract_pages(self):
+        if not self.doc:
+            QMessageBox.warning(self, "Warning", "No PDF file is open.")
+            return
+        
+        pages = self.selected_pages()
+        file_path, _ = QFileDialog.getSaveFileName(self, "Extract Pages", "", "PDF Files (*.pdf)")
+        if not file_path:
+            return
+        
+        try:
+            new_doc = fitz.open()
+            # Непрерывные диапазоны копируются одним вызовом insert_pdf
+            first = last = pages[0]
+            for page_num in pages[1:] + [None]:
+                if page_num == last + 1:
+                    last = page_num
+                    continue
+                new_doc.insert_pdf(self.doc, from_page=first, to_page=last)
+                if page_num is not None:
+                    first = last = page_num
+            new_doc.save(file_path, garbage=3)
+            new_doc.close()
+            self.statusBar().showMessage(f"Extracted {len(pages)} page(s) to {os.path.basename(file_path)}")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Could not extract pages: {str(e)}")
+    
+    def insert_pdf(self):
+        if not self.doc:
+            QMessageBox.warning(self, "Warning", "No PDF file is open.")
+            return
+        
+        file_path, _ = QFileDialog.getOpenFileName(self, "Insert PDF File", "", "PDF Files (*.pdf)")
+        if not file_path:
+            return
+        
+        try:
+            page_count = len(self.doc)
+            with fitz.open(file_path) as other:
+                self.doc.insert_pdf(other)
+            self.pages_changed(list(range(page_count)))
+            self.statusBar().showMessage(f"Inserted {len(self.doc) - page_count} page(s) from {os.path.basename(file_path)}")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Could not insert file: {str(e)}")
     
     def prev_page(self):
         if self.doc and self.current_page > 0:
@@ -430,117 +1932,367 @@ class PDFViewer(QMainWindow):
         if color.isValid():
             self.pen_color = color
     
+    def cancel_moving(self):
+        """Возвращает перетаскиваемую аннотацию на место без записи в историю"""
+        moving, self.moving = self.moving, None
+        if moving is not None and self.tab:
+            self.annotations.insert(moving['ann'], moving['index'])
+            self.drawing = False
+    
     def set_pen_width(self, width):
         self.pen_width = width
     
     def clear_annotations(self):
-        self.annotations = [ann for ann in self.annotations if ann['page'] != self.current_page]
-        self.text_annotations = [ann for ann in self.text_annotations if ann['page'] != self.current_page]
+        if not self.doc or not self.annotations.page(self.current_page):
+            return
+        self.cancel_moving()
+        self.selected_annotation = None
+        self.history.push(ClearPageCommand(self.current_page))
         self.update_annotations_list()
         self.display_page()
     
+    def undo(self):
+        if self.doc and not self.drawing:
+            self.show_changed_page(self.history.undo(), "Undo")
+    
+    def redo(self):
+        if self.doc and not self.drawing:
+            self.show_changed_page(self.history.redo(), "Redo")
+    
+    def show_changed_page(self, page_num, action):
+        """Переходит на страницу, измененную отменой/повтором"""
+        if page_num is None:
+            self.statusBar().showMessage(f"Nothing to {action.lower()}")
+            return
+        if page_num != self.current_page:
+            self.current_page = page_num
+            self.update_page_controls()
+        self.selected_annotation = None
+        self.update_annotations_list()
+        self.display_page()
+        self.statusBar().showMessage(f"{action}: page {page_num + 1}")
+    
     def update_annotations_list(self):
         self.annotations_list.clear()
-        page_annotations = [ann for ann in self.annotations if ann['page'] == self.current_page]
-        page_texts = [ann for ann in self.text_annotations if ann['page'] == self.current_page]
+        if not self.doc:
+            return
+        page_annotations = self.annotations.page(self.current_page)
         
         for ann in page_annotations:
-            self.annotations_list.addItem(f"Drawing ({len(ann['points'])} points)")
+            if ann['type'] == 'pencil':
+                self.annotations_list.addItem(f"Drawing ({len(ann['points'])} points)")
         
-        for text_ann in page_texts:
-            self.annotations_list.addItem(f"Text: {text_ann['text'][:30]}...")
+        for text_ann in page_annotations:
+            if text_ann['type'] == 'text':
+                self.annotations_list.addItem(f"Text: {text_ann['text'][:30]}...")
+        
+        for highlight in page_annotations:
+            if highlight['type'] == 'highlight':
+                self.annotations_list.addItem(f"Highlight: {highlight['text'][:30]}...")
+        
+        for redaction in page_annotations:
+            if redaction['type'] == 'redact':
+                self.annotations_list.addItem("Redaction area (not applied)")
     
-    def get_scaled_point(self, pos):
-        """Преобразует координаты мыши в координаты оригинального изображения"""
+    def redact_by_pattern(self):
+        if not self.doc:
+            QMessageBox.warning(self, "Warning", "No PDF file is open.")
+            return
+        
+        pattern, ok = QInputDialog.getText(self, "Redact by Pattern",
+                                           "Regular expression (e.g. \\d{4} \\d{6}):")
+        if not ok or not pattern:
+            return
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            QMessageBox.warning(self, "Warning", f"Invalid pattern: {str(e)}")
+            return
+        self.apply_redactions([pattern])
+    
+    def apply_redactions(self, patterns=()):
+        """Применяет отмеченные области и совпадения шаблонов ко всему документу.
+
+        Поиск по шаблонам идет в пуле процессов по копии документа на диске,
+        удаление содержимого - в открытом документе только на страницах с
+        совпадениями. Операция необратима, поэтому история правок сбрасывается.
+        """
+        if not self.doc:
+            return
+        self.cancel_moving()
+        
+        areas = {}
+        pending = [ann for ann in self.annotations if ann['type'] == 'redact']
+        for ann in pending:
+            areas.setdefault(ann['page'], []).append([ann['rect']])
+        
+        if patterns:
+            progress = QProgressDialog("Searching pages...", "Cancel", 0, len(self.doc), self)
+            progress.setWindowTitle("Redaction")
+            progress.setWindowModality(Qt.WindowModal)
+            progress.setMinimumDuration(0)
+            
+            def report(done, total):
+                progress.setValue(done)
+                QApplication.processEvents()
+                return not progress.wasCanceled()
+            
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            os.close(fd)
+            try:
+                self.doc.save(path, garbage=1)
+                found = search_redactions(path, patterns, progress=report)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Could not search document: {str(e)}")
+                return
+            finally:
+                progress.close()
+                os.remove(path)
+            if found is None:
+                self.statusBar().showMessage("Redaction cancelled")
+                return
+            for page_num, page_areas in found.items():
+                areas.setdefault(page_num, []).extend(page_areas)
+        
+        if not areas:
+            QMessageBox.information(self, "Redaction", format_redaction_report({}))
+            return
+        
+        counts = {}
+        xrefs = []
+        for page_num in sorted(areas):
+            counts[page_num] = redact_page(self.doc[page_num], areas[page_num])
+            xrefs.append(self.doc.page_xref(page_num))
+            self.tab.text_layouts.pop(xrefs[-1], None)
+        
+        for ann in pending:
+            self.annotations.remove(ann)
+        self.tab.history = UndoStack(self.annotations)
+        for page_num in counts:
+            self.annotations.touch(page_num)
+        render_cache.evict_pages(self.tab.doc_id, xrefs)
+        self.selected_annotation = None
+        self.text_selection = None
+        
+        self.update_annotations_list()
+        self.display_page()
+        self.statusBar().showMessage(f"Redacted {sum(counts.values())} item(s) on {len(counts)} page(s)")
+        QMessageBox.information(self, "Redaction", format_redaction_report(counts))
+    
+    def select_text_to(self, pdf_pos):
+        """Продлевает выделение текста до точки; раскладка берется из кэша вкладки"""
+        layout = self.tab.text_layout(self.text_selection['page'])
+        self.text_selection['caret'] = layout.caret_at(pdf_pos.x(), pdf_pos.y())
+        start, end = sorted((self.text_selection['anchor'], self.text_selection['caret']))
+        self.text_selection['rects'] = layout.selection_rects(start, end)
+        self.display_page()
+    
+    def selected_text(self):
+        if not self.doc or self.text_selection is None:
+            return ""
+        if not 0 <= self.text_selection['page'] < len(self.doc):
+            return ""
+        layout = self.tab.text_layout(self.text_selection['page'])
+        start, end = sorted((self.text_selection['anchor'], self.text_selection['caret']))
+        return layout.text(start, end)
+    
+    def copy_selected_text(self):
+        text = self.selected_text()
+        if text:
+            QApplication.clipboard().setText(text)
+            self.statusBar().showMessage(f"Copied {len(text)} characters")
+    
+    def highlight_selected_text(self):
+        text = self.selected_text()
+        if not text or not self.text_selection['rects']:
+            return
+        self.history.push(AddAnnotationCommand({
+            'type': 'highlight',
+            'page': self.text_selection['page'],
+            'color': QColor(255, 230, 0),
+            'rects': self.text_selection['rects'],
+            'text': text
+        }))
+        self.text_selection = None
+        self.update_annotations_list()
+        self.display_page()
+    
+    def get_pdf_point(self, pos):
+        """Преобразует координаты мыши в координаты страницы PDF"""
         if not self.original_pixmap or not self.pdf_label.pixmap():
-            return QPoint()
+            return QPointF()
             
         label_pixmap = self.pdf_label.pixmap()
         if not label_pixmap:
-            return QPoint()
+            return QPointF()
             
         # Получаем геометрию изображения внутри label
         label_rect = self.pdf_label.rect()
-        pixmap_rect = label_pixmap.rect()
+        # Размер изображения в логических пикселях виджета
+        pixmap_width = label_pixmap.width() / label_pixmap.devicePixelRatio()
+        pixmap_height = label_pixmap.height() / label_pixmap.devicePixelRatio()
         
         # Вычисляем отступы для центрирования
-        x_offset = (label_rect.width() - pixmap_rect.width()) // 2
-        y_offset = (label_rect.height() - pixmap_rect.height()) // 2
+        x_offset = (label_rect.width() - pixmap_width) / 2
+        y_offset = (label_rect.height() - pixmap_height) / 2
         
         # Корректируем позицию относительно изображения
-        adjusted_pos = QPoint(pos.x() - x_offset, pos.y() - y_offset)
+        adjusted_pos = QPointF(pos.x() - x_offset, pos.y() - y_offset)
         
-        # Масштабируем обратно к оригинальному размеру
-        if pixmap_rect.width() > 0 and pixmap_rect.height() > 0:
-            scale_x = self.original_pixmap.width() / pixmap_rect.width()
-            scale_y = self.original_pixmap.height() / pixmap_rect.height()
-            
-            original_x = int(adjusted_pos.x() * scale_x)
-            original_y = int(adjusted_pos.y() * scale_y)
-            
-            return QPoint(original_x, original_y)
+        # Обратное преобразование из пикселей в координаты страницы
+        inverse, invertible = self.page_transform.inverted()
+        if invertible:
+            return inverse.map(adjusted_pos)
         
-        return QPoint()
+        return QPointF()
+    
+    def delete_selected_annotation(self):
+        ann = self.selected_annotation
+        if not self.doc or ann is None or self.drawing:
+            return
+        self.selected_annotation = None
+        self.history.push(RemoveAnnotationCommand(ann))
+        self.update_annotations_list()
+        self.display_page()
+    
+    def hit_tolerance(self):
+        """Допуск попадания: несколько экранных пикселей в единицах страницы"""
+        scale = math.hypot(self.page_transform.m11(), self.page_transform.m12())
+        return 4.0 / scale if scale else 4.0
+    
+    def erase_at(self, pdf_pos):
+        ann = self.annotations.hit_test(self.current_page, pdf_pos, self.hit_tolerance())
+        if ann is None:
+            return
+        if ann is self.selected_annotation:
+            self.selected_annotation = None
+        self.history.push(RemoveAnnotationCommand(ann))
+        self.update_annotations_list()
+        self.display_page()
     
     def mousePressEvent(self, event):
         if (event.button() == Qt.LeftButton and self.pdf_label.underMouse() and 
-            self.doc and self.current_tool in ["pencil", "text"] and self.original_pixmap):
+            self.doc and self.current_tool != "pan" and self.original_pixmap):
             
             pos = self.pdf_label.mapFrom(self, event.pos())
-            original_pos = self.get_scaled_point(pos)
+            pdf_pos = self.get_pdf_point(pos)
             
-            # Проверяем, что клик внутри изображения
-            original_rect = self.original_pixmap.rect()
-            if not original_rect.contains(original_pos):
+            # Проверяем, что клик внутри страницы
+            if not self.page_bounds.contains(pdf_pos):
                 return
             
             if self.current_tool == "pencil":
                 self.drawing = True
-                self.last_point = original_pos
-                self.annotations.append({
+                self.last_point = pdf_pos
+                path = QPainterPath(pdf_pos)
+                self.active_stroke = {
                     'type': 'pencil',
                     'page': self.current_page,
                     'color': self.pen_color,
                     'width': self.pen_width,
-                    'points': [original_pos]
-                })
+                    'points': [(pdf_pos.x(), pdf_pos.y())],
+                    'path': path
+                }
             
             elif self.current_tool == "text":
                 text = self.text_input.toPlainText().strip()
                 if text:
-                    self.text_annotations.append({
+                    self.history.push(AddAnnotationCommand({
                         'type': 'text',
                         'page': self.current_page,
                         'text': text,
                         'color': self.pen_color,
-                        'position': original_pos
-                    })
+                        'position': pdf_pos
+                    }))
                     self.text_input.clear()
                     self.display_page()
                     self.update_annotations_list()
+            
+            elif self.current_tool in ("select", "move"):
+                ann = self.annotations.hit_test(self.current_page, pdf_pos, self.hit_tolerance())
+                self.selected_annotation = ann
+                if ann is not None and self.current_tool == "move":
+                    # На время перетаскивания аннотация убирается из слоя страницы
+                    self.drawing = True
+                    index = self.annotations.remove(ann)
+                    self.moving = {'ann': ann, 'index': index,
+                                   'start': pdf_pos, 'offset': QPointF()}
+                self.display_page()
+            
+            elif self.current_tool == "erase":
+                self.drawing = True
+                self.erase_at(pdf_pos)
+            
+            elif self.current_tool == "select_text":
+                self.drawing = True
+                caret = self.tab.text_layout(self.current_page).caret_at(pdf_pos.x(), pdf_pos.y())
+                self.text_selection = {'page': self.current_page, 'anchor': caret,
+                                       'caret': caret, 'rects': []}
+                self.display_page()
+            
+            elif self.current_tool == "redact":
+                self.drawing = True
+                x, y = pdf_pos.x(), pdf_pos.y()
+                self.active_stroke = {
+                    'type': 'redact',
+                    'page': self.current_page,
+                    'start': (x, y),
+                    'rect': (x, y, x, y)
+                }
     
     def mouseMoveEvent(self, event):
         if (event.buttons() & Qt.LeftButton and self.drawing and 
-            self.current_tool == "pencil" and self.pdf_label.underMouse() and
-            self.original_pixmap):
+            self.pdf_label.underMouse() and self.original_pixmap):
             
             pos = self.pdf_label.mapFrom(self, event.pos())
-            original_pos = self.get_scaled_point(pos)
+            pdf_pos = self.get_pdf_point(pos)
             
-            # Проверяем, что движение внутри изображения
-            original_rect = self.original_pixmap.rect()
-            if not original_rect.contains(original_pos):
+            # Проверяем, что движение внутри страницы
+            if not self.page_bounds.contains(pdf_pos):
                 return
             
-            if self.annotations:
-                self.annotations[-1]['points'].append(original_pos)
-                self.last_point = original_pos
+            if self.current_tool == "erase":
+                self.erase_at(pdf_pos)
+            
+            elif self.text_selection is not None and self.current_tool == "select_text":
+                self.select_text_to(pdf_pos)
+            
+            elif self.moving is not None:
+                self.moving['offset'] = pdf_pos - self.moving['start']
+                self.display_page()
+            
+            elif self.active_stroke is not None and self.active_stroke['type'] == 'redact':
+                x0, y0 = self.active_stroke['start']
+                x1, y1 = pdf_pos.x(), pdf_pos.y()
+                self.active_stroke['rect'] = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+                self.display_page()
+            
+            elif self.active_stroke is not None:
+                # Путь штриха достраивается по точке, а не пересобирается
+                self.active_stroke['points'].append((pdf_pos.x(), pdf_pos.y()))
+                self.active_stroke['path'].lineTo(pdf_pos)
+                self.last_point = pdf_pos
                 self.display_page()
     
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton and self.drawing:
             self.drawing = False
+            stroke, self.active_stroke = self.active_stroke, None
+            if stroke is not None and stroke['type'] == 'redact':
+                x0, y0, x1, y1 = stroke['rect']
+                if x1 > x0 and y1 > y0:
+                    del stroke['start']
+                    self.history.push(AddAnnotationCommand(stroke))
+            elif stroke is not None:
+                self.history.push(AddAnnotationCommand(stroke))
+            moving, self.moving = self.moving, None
+            if moving is not None:
+                self.annotations.insert(moving['ann'], moving['index'])
+                offset = moving['offset']
+                if not offset.isNull():
+                    self.history.push(MoveAnnotationCommand(moving['ann'], offset.x(), offset.y()))
             self.update_annotations_list()
+            self.display_page()
     
     def resizeEvent(self, event):
         """Перерисовываем страницу при изменении размера окна"""
@@ -548,6 +2300,19 @@ class PDFViewer(QMainWindow):
         if self.doc:
             self.display_page()
     
+    def showEvent(self, event):
+        super().showEvent(event)
+        # windowHandle появляется только у показанного окна
+        window = self.windowHandle()
+        if window is not None and not self.screen_tracked:
+            window.screenChanged.connect(self.screen_changed)
+            self.screen_tracked = True
+    
+    def screen_changed(self, screen):
+        """Окно перенесено на другой монитор - перерисовываем под его плотность пикселей"""
+        if self.doc:
+            self.display_page()
+    
     def print_file(self):
         if not self.doc:
             QMessageBox.warning(self, "Warning", "No PDF file is open.")
@@ -561,6 +2326,9 @@ class PDFViewer(QMainWindow):
 
 
 def main():
+    # Рендерим в физических пикселях на экранах с высокой плотностью
+    QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
+    QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
     app = QApplication(sys.argv)
     app.setApplicationName("PDF Viewer with Annotations")
     
@@ -1,12 +1,15 @@
 import sys
 import os
+from collections import OrderedDict
 import fitz  # PyMuPDF
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                              QWidget, QPushButton, QLabel, QSlider, QFileDialog,
-                             QLineEdit, QToolBar, QStatusBar, QMessageBox, QComboBox)
+                             QLineEdit, QToolBar, QStatusBar, QMessageBox, QComboBox,
+                             QCheckBox)
 from PyQt5.QtCore import Qt, QRectF
 from PyQt5.QtGui import QPixmap, QImage, QPainter, QWheelEvent, QMouseEvent
 from PyQt5.QtPrintSupport import QPrintDialog, QPrinter
+from PDF_redaktor import optimize_pdf, format_optimize_report, OPTIMIZE_TARGET_DPI
 
 
 class PDFViewer(QMainWindow):
@@ -61,6 +64,12 @@ class PDFViewer(QMainWindow):
         save_btn.clicked.connect(self.saveFile)
         toolbar.addWidget(save_btn)
         
+        # Оптимизация при сохранении
+        self.optimize_check = QCheckBox('Оптимизировать')
+        self.optimize_check.setToolTip(
+            f'Уменьшать изображения до {OPTIMIZE_TARGET_DPI} DPI и пересжимать потоки при сохранении')
+        toolbar.addWidget(self.optimize_check)
+        
         toolbar.addSeparator()
         
         # Навигация по страницам
@@ -133,6 +142,7 @@ class PDFViewer(QMainWindow):
                 # Закрываем предыдущий документ
                 if self.pdf_document:
                     self.pdf_document.close()
+                    self.viewer_widget.render_cache.clear()
                 
                 self.pdf_document = fitz.open(file_path)
                 self.total_pages = len(self.pdf_document)
@@ -161,11 +171,36 @@ class PDFViewer(QMainWindow):
         
         if file_path:
             try:
-                # Создаем копию документа
-                new_doc = fitz.open()
-                new_doc.insert_pdf(self.pdf_document)
-                new_doc.save(file_path)
-                new_doc.close()
+                if self.optimize_check.isChecked():
+                    # Оптимизируется копия, открытый документ не меняется
+                    # Выигрыш считается от исходного файла на диске, а не от копии
+                    source_size = (os.path.getsize(self.pdf_document.name)
+                                   if os.path.exists(self.pdf_document.name) else None)
+                    QApplication.setOverrideCursor(Qt.WaitCursor)
+                    try:
+                        report = optimize_pdf(self.pdf_document.tobytes(), file_path,
+                                              source_size=source_size)
+                    finally:
+                        QApplication.restoreOverrideCursor()
+                    self.status_bar.showMessage(format_optimize_report(report))
+                    QMessageBox.information(self, "Успех",
+                                            f"Файл успешно сохранен!\n\n{format_optimize_report(report)}")
+                    return
+                
+                if os.path.abspath(file_path) == os.path.abspath(self.pdf_document.name):
+                    # Открытый файл можно перезаписать только дозаписью;
+                    # восстановленный при открытии файл пишется через копию
+                    if self.pdf_document.can_save_incrementally():
+                        self.pdf_document.save(file_path, incremental=True,
+                                               encryption=fitz.PDF_ENCRYPT_KEEP)
+                    else:
+                        temp_path = file_path + ".tmp"
+                        self.pdf_document.save(temp_path, garbage=3)
+                        os.replace(temp_path, file_path)
+                else:
+                    # Сохраняем документ целиком, без постраничной пересборки;
+                    # garbage=3 выбрасывает неиспользуемые объекты
+                    self.pdf_document.save(file_path, garbage=3)
                 
                 self.status_bar.showMessage(f'Файл сохранен: {os.path.basename(file_path)}')
                 QMessageBox.information(self, "Успех", "Файл успешно сохранен!")
@@ -231,6 +266,10 @@ class PDFViewer(QMainWindow):
             self.status_bar.showMessage('Готов')
 
 
+# Сколько отрендеренных страниц хранит виджет просмотра
+RENDER_CACHE_SIZE = 8
+
+
 class PDFViewerWidget(QWidget):
     def __init__(self, parent):
         super().__init__(parent)
@@ -238,6 +277,34 @@ class PDFViewerWidget(QWidget):
         self.setMouseTracking(True)
         self.dragging = False
         self.last_mouse_pos = None
+        # (документ, страница, масштаб, devicePixelRatio) -> QImage
+        self.render_cache = OrderedDict()
+        
+    def renderPage(self):
+        """Возвращает текущую страницу, отрендеренную в физических пикселях экрана"""
+        dpr = self.devicePixelRatioF()
+        key = (id(self.parent.pdf_document), self.parent.current_page,
+               self.parent.scale_factor, dpr)
+        qimage = self.render_cache.get(key)
+        if qimage is not None:
+            self.render_cache.move_to_end(key)
+            return qimage
+        
+        page = self.parent.pdf_document[self.parent.current_page]
+        
+        # Матрица с учетом масштаба и плотности пикселей экрана
+        scale = self.parent.scale_factor * dpr
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
+        
+        # copy() - QImage не должен ссылаться на буфер pixmap
+        qimage = QImage(pix.samples, pix.width, pix.height, pix.stride,
+                        QImage.Format_RGB888).copy()
+        qimage.setDevicePixelRatio(dpr)
+        
+        self.render_cache[key] = qimage
+        if len(self.render_cache) > RENDER_CACHE_SIZE:
+            self.render_cache.popitem(last=False)
+        return qimage
         
     def paintEvent(self, event):
         if not self.parent.pdf_document:
@@ -247,20 +314,16 @@ class PDFViewerWidget(QWidget):
         painter.fillRect(self.rect(), Qt.white)
         
         try:
-            # Получаем страницу
-            page = self.parent.pdf_document[self.parent.current_page]
-            
-            # Создаем матрицу для рендеринга с учетом масштаба
-            mat = fitz.Matrix(self.parent.scale_factor, self.parent.scale_factor)
-            pix = page.get_pixmap(matrix=mat)
+            # Страница из кэша: панорамирование не вызывает повторный рендеринг
+            qimage = self.renderPage()
             
-            # Конвертируем в QImage
-            img_data = pix.samples
-            qimage = QImage(img_data, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
+            # Размер изображения в логических пикселях виджета
+            width = int(qimage.width() / qimage.devicePixelRatio())
+            height = int(qimage.height() / qimage.devicePixelRatio())
             
             # Рассчитываем позицию для отрисовки с учетом панорамирования
-            x_offset = self.parent.pan_offset[0] + (self.width() - pix.width) // 2
-            y_offset = self.parent.pan_offset[1] + (self.height() - pix.height) // 2
+            x_offset = self.parent.pan_offset[0] + (self.width() - width) // 2
+            y_offset = self.parent.pan_offset[1] + (self.height() - height) // 2
             
             # Рисуем изображение
             painter.drawImage(x_offset, y_offset, qimage)
@@ -295,6 +358,9 @@ class PDFViewerWidget(QWidget):
 
 
 def main():
+    # Рендерим в физических пикселях на экранах с высокой плотностью
+    QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
+    QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
     app = QApplication(sys.argv)
     
     # Устанавливаем стиль для более современного вида